@@ -5,6 +5,8 @@ MP3 转 MIDI 工具
 
 用法:
     python audio_to_midi.py <input_mp3> [output_dir]
+    python audio_to_midi.py --batch <input_dir|mp3...> [-o output_dir]  # 批量处理
+    python audio_to_midi.py --serve  # 常驻模式，从 stdin 逐行读取 JSON 任务
     python audio_to_midi.py --check  # 检查依赖和硬件
 
 输出:
@@ -16,16 +18,60 @@ import os
 import json
 import subprocess
 import shutil
+import fnmatch
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+# 延迟加载 CUDA 模块，避免导入 torch 时一次性加载全部 kernel
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
 
-def output_json(data):
-    """输出 JSON 格式结果"""
-    print(json.dumps(data, ensure_ascii=False, indent=2))
+# torch/TF 默认按逻辑核数开线程，这里限制为一半，减少与其他进程争抢缓存；
+# 必须在导入 torch/TensorFlow 之前设置，已有的环境变量保持不变
+DEFAULT_NUM_THREADS = max(1, (os.cpu_count() or 2) // 2)
+for _key in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+             "TF_NUM_INTRAOP_THREADS"):
+    os.environ.setdefault(_key, str(DEFAULT_NUM_THREADS))
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", "2")
+
+
+# 常驻模式下的协议输出流；其余模式为 None，直接写 sys.stdout
+_PROTOCOL_OUT = None
+
+
+def output_json(data, compact=False):
+    """
+    输出 JSON 格式结果
+
+    Args:
+        data: 要输出的数据
+        compact: 是否紧凑输出 (单行、无缩进)，用于高频的进度事件
+    """
+    if compact:
+        text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+    out = _PROTOCOL_OUT or sys.stdout
+    out.write(text + "\n")
+    out.flush()
+
+
+# 硬件检测和依赖检查结果在进程内缓存，批量处理时不再重复探测
+_HW_CACHE = None
+_DEPS_CACHE = None
 
 
 def detect_hardware():
+    """检测可用硬件加速 (结果在进程内缓存)"""
+    global _HW_CACHE
+    if _HW_CACHE is None:
+        _HW_CACHE = _detect_hardware_impl()
+    return _HW_CACHE
+
+
+def _detect_hardware_impl():
     """检测可用硬件加速"""
     try:
         import torch
@@ -56,33 +102,36 @@ def detect_hardware():
 
 
 def check_dependencies():
-    """检查依赖是否安装"""
+    """检查依赖是否安装 (结果在进程内缓存)"""
+    global _DEPS_CACHE
+    if _DEPS_CACHE is None:
+        _DEPS_CACHE = _check_dependencies_impl()
+    return _DEPS_CACHE
+
+
+def _check_dependencies_impl():
+    """检查依赖是否安装 (只读取已安装包的元数据，不导入 torch 等重量级模块)"""
+    from importlib.metadata import PackageNotFoundError, version
+
     dependencies = {
         "demucs": {"installed": False, "version": None},
         "basic_pitch": {"installed": False, "version": None},
         "torch": {"installed": False, "version": None},
     }
 
-    try:
-        import demucs
-        dependencies["demucs"]["installed"] = True
-        dependencies["demucs"]["version"] = getattr(demucs, '__version__', 'unknown')
-    except ImportError:
-        pass
-
-    try:
-        import basic_pitch
-        dependencies["basic_pitch"]["installed"] = True
-        dependencies["basic_pitch"]["version"] = getattr(basic_pitch, '__version__', 'unknown')
-    except ImportError:
-        pass
+    # 依赖名 -> 发行包名
+    packages = {
+        "demucs": "demucs",
+        "basic_pitch": "basic-pitch",
+        "torch": "torch",
+    }
 
-    try:
-        import torch
-        dependencies["torch"]["installed"] = True
-        dependencies["torch"]["version"] = torch.__version__
-    except ImportError:
-        pass
+    for name, package in packages.items():
+        try:
+            dependencies[name]["version"] = version(package)
+            dependencies[name]["installed"] = True
+        except PackageNotFoundError:
+            pass
 
     return dependencies
 
@@ -92,27 +141,404 @@ def check_command_available(cmd):
     return shutil.which(cmd) is not None
 
 
-def separate_vocals(input_mp3, output_dir, device="cpu"):
+# Demucs 分段推理的重叠比例 (与 demucs 默认值一致)
+DEMUCS_OVERLAP = 0.25
+
+# htdemucs 的输入格式
+DEMUCS_SAMPLERATE = 44100
+DEMUCS_CHANNELS = 2
+
+# Demucs 模型单例，避免每个文件都重新启动解释器和加载模型
+_DEMUCS_MODEL = None
+
+
+def _get_demucs_model(device="cpu"):
+    """获取 (必要时加载) 常驻的 htdemucs 模型"""
+    global _DEMUCS_MODEL
+    if _DEMUCS_MODEL is None:
+        from demucs.pretrained import get_model
+        model = get_model("htdemucs")
+
+        # get_model 在 CPU 上加载权重；这里一次性移到推理设备并常驻，
+        # apply_model 和 CUDA 分段推理直接在该设备上调用子模型
+        if device != "cpu":
+            model.to(device)
+
+        if device == "cuda":
+            import torch
+            # 频谱分支的 Conv2d 权重改为 NHWC 布局，配合 cudnn.benchmark 选用 NHWC 算法
+            torch.backends.cudnn.benchmark = True
+            model.to(memory_format=torch.channels_last)
+        _DEMUCS_MODEL = model
+    return _DEMUCS_MODEL
+
+
+# 半精度推理遇到不支持的算子时置为 False，后续直接使用 FP32
+_DEMUCS_AUTOCAST = True
+
+# CUDA 上并发执行 Demucs 分段推理的 stream 数
+DEMUCS_CUDA_STREAMS = 2
+
+# 各 CUDA stream 上的 Demucs 推理槽位，首次使用时创建
+_DEMUCS_SLOTS = None
+
+# Demucs 分段重叠相加使用的三角窗
+_DEMUCS_WINDOW = None
+
+
+class _DemucsCudaSlot:
+    """
+    单个 CUDA stream 上的 Demucs 分段推理槽位
+
+    Demucs 按固定长度分段推理，每段输入形状相同。每个槽位拥有独立的
+    stream 和输入缓冲区，多个槽位轮流使用，让相邻分段的计算重叠。
+    """
+
+    def __init__(self, model, channels, segment_length):
+        import torch
+
+        self.model = model
+        self.stream = torch.cuda.Stream()
+        self.input = torch.zeros(1, channels, segment_length, device="cuda")
+        # 主 stream 用完本槽位输出后记录的事件，复用缓冲区前需等待
+        self.consumed = None
+
+    def run(self, chunk, segment_length):
+        """在本槽位的 stream 上异步计算一个分段，返回输出张量"""
+        import torch
+
+        if self.consumed is not None:
+            self.stream.wait_event(self.consumed)
+        else:
+            self.stream.wait_stream(torch.cuda.current_stream())
+
+        with torch.cuda.stream(self.stream):
+            self.input.copy_(chunk.padded(segment_length), non_blocking=True)
+            return self.model(self.input)
+
+
+def _get_demucs_window(segment_length):
+    """获取 (必要时创建) 重叠相加使用的三角窗，常驻 GPU"""
+    global _DEMUCS_WINDOW
+    if _DEMUCS_WINDOW is None or _DEMUCS_WINDOW.shape[0] != segment_length:
+        import torch
+        window = torch.cat([
+            torch.arange(1, segment_length // 2 + 1, device="cuda"),
+            torch.arange(segment_length - segment_length // 2, 0, -1, device="cuda")
+        ]).float()
+        _DEMUCS_WINDOW = window / window.max()
+    return _DEMUCS_WINDOW
+
+
+def _get_demucs_slots(model, channels, segment_length):
+    """获取 (必要时创建) 各 CUDA stream 上的 Demucs 推理槽位"""
+    global _DEMUCS_SLOTS
+    if _DEMUCS_SLOTS is None:
+        _DEMUCS_SLOTS = [
+            _DemucsCudaSlot(model, channels, segment_length)
+            for _ in range(DEMUCS_CUDA_STREAMS)
+        ]
+    return _DEMUCS_SLOTS
+
+
+def _decode_audio(input_path, samplerate, channels):
+    """
+    将音频解码为内存中的 float32 张量 [channels, samples]
+
+    优先通过 ffmpeg 管道直接输出 PCM，不经过临时文件；
+    没有 ffmpeg 时回退到 torchaudio。
+    """
+    import numpy as np
+    import torch
+
+    if check_command_available("ffmpeg"):
+        cmd = [
+            "ffmpeg", "-v", "error",
+            "-i", str(input_path),
+            "-f", "f32le",
+            "-ar", str(samplerate),
+            "-ac", str(channels),
+            "pipe:1"
+        ]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            reason = proc.stderr.decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"ffmpeg 解码失败: {reason or f'退出码 {proc.returncode}'}")
+        wav = np.frombuffer(proc.stdout, dtype=np.float32).reshape(-1, channels).T
+        return torch.from_numpy(wav.copy())
+
+    import torchaudio
+    from demucs.audio import convert_audio
+    wav, sample_rate = torchaudio.load(str(input_path))
+    return convert_audio(wav, sample_rate, samplerate, channels)
+
+
+def _apply_demucs(model, wav, device):
+    """
+    用 demucs.apply.apply_model 分段推理 (与 demucs 命令行的归一化方式一致)
+
+    Returns:
+        {音轨名: [channels, samples] 张量}，保留在推理设备上
+    """
+    from demucs.apply import apply_model
+
+    wav = wav.to(device)
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / (ref.std() + 1e-8)
+    sources = apply_model(model, wav[None], overlap=DEMUCS_OVERLAP, device=device)[0]
+    sources = sources * (ref.std() + 1e-8) + ref.mean()
+    return dict(zip(model.sources, sources))
+
+
+def _separate_cuda(model, wav):
+    """
+    在 CUDA 上逐段运行 Demucs 并重叠相加
+
+    与 demucs.apply.apply_model 的分段方式一致 (不做随机平移)。
+    音频一次性拷到 GPU，各分段轮流分配到多个 CUDA stream 上并发计算，
+    重叠相加在主 stream 上按顺序完成。
+    """
+    import torch
+    from demucs.apply import BagOfModels, TensorChunk
+    from demucs.utils import center_trim
+
+    if isinstance(model, BagOfModels):
+        if len(model.models) != 1:
+            return _apply_demucs(model, wav, "cuda")
+        model = model.models[0]
+
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / (ref.std() + 1e-8)
+
+    mix = wav[None].to("cuda")
+    length = mix.shape[-1]
+    segment_length = int(model.samplerate * model.segment)
+    stride = int((1 - DEMUCS_OVERLAP) * segment_length)
+
+    window = _get_demucs_window(segment_length)
+    slots = _get_demucs_slots(model, mix.shape[1], segment_length)
+    main_stream = torch.cuda.current_stream()
+
+    # 结果和权重缓冲区按最终形状一次性分配，各分段原地累加
+    total = torch.zeros(len(model.sources), mix.shape[1], length, device="cuda")
+    weight_sum = torch.zeros(length, device="cuda")
+    for index, offset in enumerate(range(0, length, stride)):
+        slot = slots[index % len(slots)]
+        chunk = TensorChunk(mix, offset, segment_length)
+        chunk_out = slot.run(chunk, segment_length)
+
+        # 主 stream 只等待当前分段，其余槽位上的分段可继续计算
+        main_stream.wait_stream(slot.stream)
+        end = offset + chunk.length
+        total[..., offset:end].addcmul_(center_trim(chunk_out, chunk.length)[0], window[:chunk.length])
+        weight_sum[offset:end].add_(window[:chunk.length])
+        slot.consumed = main_stream.record_event()
+
+    total.div_(weight_sum).mul_(ref.std() + 1e-8).add_(ref.mean())
+    return dict(zip(model.sources, total))
+
+
+def _separate(model, wav, device):
+    """运行 Demucs 分离，返回各音轨字典"""
+    if device == "cuda":
+        return _separate_cuda(model, wav)
+    return _apply_demucs(model, wav, device)
+
+
+def _demucs_autocast_dtype(device):
+    """返回 Demucs 在该设备上使用的半精度类型，CPU 返回 None"""
+    import torch
+    if device == "cuda":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    if device == "mps":
+        return torch.float16
+    return None
+
+
+# 半精度算子或 autocast 设备不受支持时，torch 报错信息中包含的关键字
+AUTOCAST_UNSUPPORTED_MARKERS = ("Half", "BFloat16", "autocast")
+
+
+def _is_autocast_unsupported(error):
+    """判断异常是否由半精度算子或 autocast 设备不受支持引起 (显存不足等其他错误除外)"""
+    import torch
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return False
+    message = str(error)
+    return any(marker in message for marker in AUTOCAST_UNSUPPORTED_MARKERS)
+
+
+def _run_demucs(model, wav, device):
+    """在 inference_mode 下运行 Demucs，GPU 上启用 autocast 半精度"""
+    global _DEMUCS_AUTOCAST
+    import torch
+
+    dtype = _demucs_autocast_dtype(device) if _DEMUCS_AUTOCAST else None
+    if dtype is not None:
+        try:
+            with torch.inference_mode(), torch.autocast(device_type=device, dtype=dtype):
+                return _separate(model, wav, device)
+        except RuntimeError as e:
+            if not _is_autocast_unsupported(e):
+                raise
+            _DEMUCS_AUTOCAST = False
+
+    with torch.inference_mode():
+        return _separate(model, wav, device)
+
+
+def separate_vocals(input_mp3, output_dir, device="cpu", wav=None):
     """
     使用 Demucs 分离人声
 
+    优先在进程内加载 htdemucs 模型推理，模型只加载一次，人声保留在内存中；
+    当前环境无法导入 demucs 时回退到命令行。
+
     Args:
         input_mp3: 输入 MP3 文件路径
-        output_dir: 输出目录
+        output_dir: 输出目录 (仅命令行回退时写入)
         device: 使用的设备 (cuda/mps/cpu)
+        wav: 已解码的输入音频 (可选，省去重复解码)
 
     Returns:
-        vocals_path: 人声文件路径
+        vocals: (人声音频 [channels, samples] 张量或数组, 采样率)
     """
     input_path = Path(input_mp3)
     output_path = Path(output_dir)
 
+    try:
+        model = _get_demucs_model(device)
+    except ImportError:
+        vocals_path, error = _separate_vocals_cli(input_path, output_path, device)
+        if error:
+            return None, error
+
+        import librosa
+        audio, sample_rate = librosa.load(vocals_path, sr=None, mono=False)
+        return (audio, sample_rate), None
+    except Exception as e:
+        return None, f"Demucs 模型加载失败: {str(e)}"
+
+    try:
+        if wav is None:
+            wav = _decode_audio(input_path, model.samplerate, model.audio_channels)
+        separated = _run_demucs(model, wav, device)
+        # 保留在推理设备上，后续下混和重采样直接在该设备完成
+        vocals = separated["vocals"].float()
+        return (vocals, model.samplerate), None
+
+    except Exception as e:
+        return None, f"Demucs 执行异常: {str(e)}"
+
+
+# 人声音轨判断: 侧声道与中置声道能量比低于该值视为近似单声道的干净人声
+VOCAL_STEM_SIDE_RATIO = 0.02
+# 能量比低于该值说明左右声道完全一致 (单声道编码)，不作为人声依据
+VOCAL_STEM_MONO_RATIO = 1e-6
+VOCAL_STEM_NAME_PATTERNS = ("*vocal*", "*acap*")
+# 伴奏音轨 (如 Demucs 输出的 no_vocals.wav) 的文件名，不能跳过分离
+NON_VOCAL_STEM_NAME_PATTERNS = ("*no_vocal*", "*no vocal*", "*no-vocal*", "*novocal*", "*instrumental*")
+
+
+def _is_vocal_stem(input_path, wav):
+    """
+    粗略判断输入是否已是干净的人声音轨
+
+    文件名包含 vocal/acap，或左右声道几乎一致 (侧声道能量极低) 时，
+    认为无需再用 Demucs 分离。伴奏文件名 (no_vocals/instrumental) 和
+    单声道编码 (左右声道完全相同) 的输入不在此列。
+
+    Args:
+        input_path: 输入文件路径
+        wav: 解码后的立体声音频 [2, samples]
+
+    Returns:
+        是否跳过人声分离
+    """
+    name = Path(input_path).name.lower()
+    if any(fnmatch.fnmatch(name, pattern) for pattern in NON_VOCAL_STEM_NAME_PATTERNS):
+        return False
+    if any(fnmatch.fnmatch(name, pattern) for pattern in VOCAL_STEM_NAME_PATTERNS):
+        return True
+
+    left, right = wav[0], wav[1]
+    mid_energy = ((left + right) / 2).pow(2).mean()
+    if mid_energy == 0:
+        return False
+    side_energy = ((left - right) / 2).pow(2).mean()
+    ratio = float(side_energy / mid_energy)
+    return VOCAL_STEM_MONO_RATIO <= ratio < VOCAL_STEM_SIDE_RATIO
+
+
+def _run_streaming(cmd, timeout, env=None, tail_lines=200):
+    """
+    运行子进程并逐行输出进度
+
+    子进程的 stdout/stderr 合并后逐行读取，每行立即以 progress 事件输出，
+    只保留最后 tail_lines 行用于错误报告。
+
+    Args:
+        cmd: 命令参数列表
+        timeout: 超时时间 (秒)，超时后终止子进程
+        env: 子进程环境变量
+        tail_lines: 保留的尾部输出行数
+
+    Returns:
+        (returncode, 尾部输出文本)
+
+    Raises:
+        subprocess.TimeoutExpired: 子进程超时被终止
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1,
+        text=True,
+        env=env
+    )
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+
+    tail = deque(maxlen=tail_lines)
+    try:
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            tail.append(line)
+            output_json({"status": "progress", "line": line}, compact=True)
+        proc.wait()
+    finally:
+        timer.cancel()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    return proc.returncode, "\n".join(tail)
+
+
+# Demucs 自带模型的输出目录名，按优先级依次查找
+DEMUCS_MODEL_NAMES = ("htdemucs", "htdemucs_ft", "mdx_extra", "mdx", "mdx_q", "mdx_extra_q")
+
+
+def _separate_vocals_cli(input_path, output_path, device="cpu"):
+    """通过 demucs 命令行分离人声 (进程内无法导入 demucs 时的回退路径)"""
     # 构建 demucs 命令
     cmd = [
         sys.executable, "-m", "demucs",
         "--two-stems=vocals",  # 只分离人声和伴奏
         "-o", str(output_path),
         "--device", device if device != "mps" else "mps",
+        "--segment", "7",  # htdemucs 训练片段为 7.8 秒，不能超过
+        "--overlap", "0.1",
     ]
 
     # 添加输入文件
@@ -120,34 +546,24 @@ def separate_vocals(input_mp3, output_dir, device="cpu"):
 
     # 执行命令
     try:
-        result = subprocess.run(
+        returncode, output = _run_streaming(
             cmd,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 分钟超时
+            timeout=1800,  # 30 分钟超时
+            env={**os.environ, "TORCH_CUDNN_V8_API_ENABLED": "1"}
         )
 
-        if result.returncode != 0:
-            return None, f"Demucs 执行失败: {result.stderr}"
+        if returncode != 0:
+            return None, f"Demucs 执行失败: {output}"
 
         # 查找输出的人声文件
-        # Demucs 输出格式: output_dir/htdemucs/song_name/vocals.wav
+        # Demucs 输出格式: output_dir/<model>/song_name/vocals.wav
         song_name = input_path.stem
-        vocals_path = output_path / "htdemucs" / song_name / "vocals.wav"
-
-        if not vocals_path.exists():
-            # 尝试其他可能的路径
-            for model_dir in output_path.iterdir():
-                if model_dir.is_dir():
-                    possible_path = model_dir / song_name / "vocals.wav"
-                    if possible_path.exists():
-                        vocals_path = possible_path
-                        break
-
-        if vocals_path.exists():
-            return str(vocals_path), None
-        else:
-            return None, f"未找到人声文件，请检查 {output_path} 目录"
+        for model_name in DEMUCS_MODEL_NAMES:
+            vocals_path = output_path / model_name / song_name / "vocals.wav"
+            if vocals_path.exists():
+                return str(vocals_path), None
+
+        return None, f"未找到人声文件，请检查 {output_path} 目录"
 
     except subprocess.TimeoutExpired:
         return None, "Demucs 处理超时 (超过 30 分钟)"
@@ -155,53 +571,372 @@ def separate_vocals(input_mp3, output_dir, device="cpu"):
         return None, f"Demucs 执行异常: {str(e)}"
 
 
-def convert_to_midi(vocals_wav, output_dir):
+# Basic Pitch 推理参数，与 basic-pitch 命令行默认值保持一致
+BP_ONSET_THRESHOLD = 0.5
+BP_FRAME_THRESHOLD = 0.3
+BP_MINIMUM_NOTE_LENGTH_MS = 127.70
+BP_OVERLAPPING_FRAMES = 30
+BP_ENERGY_TOLERANCE = 11
+
+# Basic Pitch 模型单例，同一进程内只加载一次
+_BP_MODEL = None
+
+
+def _get_bp_model(device="cpu"):
+    """获取 (必要时加载) 常驻的 Basic Pitch 模型"""
+    global _BP_MODEL
+    if _BP_MODEL is None:
+        from basic_pitch import ICASSP_2022_MODEL_PATH
+        from basic_pitch.inference import Model
+        _configure_tf_gpu_memory()
+        model = Model(ICASSP_2022_MODEL_PATH)
+        if device == "mps":
+            model = _use_coreml_all_compute_units(model)
+        _BP_MODEL = _compile_bp_model(model)
+    return _BP_MODEL
+
+
+def _configure_tf_gpu_memory():
     """
-    使用 Basic Pitch 将人声转换为 MIDI
+    让 TensorFlow 按需申请显存
+
+    Basic Pitch (TensorFlow) 与 Demucs (torch) 在同一进程中运行，
+    TensorFlow 默认会占用几乎全部显存，导致 Demucs 显存不足。
+    必须在 TensorFlow 初始化 GPU 之前调用。
+    """
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+
+    for gpu in tf.config.list_physical_devices("GPU"):
+        try:
+            tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError:
+            pass  # GPU 已经初始化，无法再修改
+
+
+def _use_coreml_all_compute_units(model):
+    """
+    Apple Silicon 上让 Basic Pitch 的 CoreML 模型使用 GPU/神经引擎
+
+    basic_pitch 以 CPU_ONLY 加载 CoreML 模型，按 FP32 在 CPU 上运行；
+    改为 ComputeUnit.ALL 后可由 GPU/神经引擎以 FP16 执行。
+    """
+    from basic_pitch import ICASSP_2022_MODEL_PATH
+    from basic_pitch.inference import Model
+    if model.model_type != Model.MODEL_TYPES.COREML:
+        return model
+
+    try:
+        import coremltools as ct
+        model.model = ct.models.MLModel(
+            str(ICASSP_2022_MODEL_PATH),
+            compute_units=ct.ComputeUnit.ALL
+        )
+    except Exception:
+        pass  # 保持 CPU_ONLY
+    return model
+
+
+def _compile_bp_model(model):
+    """
+    TensorFlow 后端下用 XLA 编译 Basic Pitch 前向
+
+    模型由许多小的卷积和 sigmoid 算子组成，jit_compile 后融合为少量 kernel；
+    以 2 秒空白音频预热两次，编译失败时保留原始模型。
+    """
+    from basic_pitch.inference import Model
+    if model.model_type != Model.MODEL_TYPES.TENSORFLOW:
+        return model
+
+    import numpy as np
+    import tensorflow as tf
+    from basic_pitch.constants import AUDIO_N_SAMPLES
+
+    eager = model.model
+    try:
+        model.model = tf.function(eager, jit_compile=True)
+        dummy = np.zeros((1, AUDIO_N_SAMPLES, 1), dtype=np.float32)
+        for _ in range(2):
+            model.predict(dummy)
+    except Exception:
+        model.model = eager
+    return model
+
+
+def _run_basic_pitch(audio, model_or_model_path):
+    """
+    对内存中的单声道音频执行 Basic Pitch 推理
+
+    basic_pitch.inference.predict 只接受文件路径，这里按同样的方式
+    分窗推理并拼接输出，避免把人声写入临时文件。
 
     Args:
-        vocals_wav: 人声 WAV 文件路径
-        output_dir: 输出目录
+        audio: 22050 Hz 单声道 float32 音频
+        model_or_model_path: Basic Pitch 模型或模型路径
 
     Returns:
-        midi_path: MIDI 文件路径
+        模型输出字典 (note/onset/contour)
     """
-    vocals_path = Path(vocals_wav)
-    output_path = Path(output_dir)
+    import numpy as np
+    from basic_pitch.constants import AUDIO_N_SAMPLES, FFT_HOP
+    from basic_pitch.inference import Model, unwrap_output
 
-    # 构建 basic-pitch 命令
-    cmd = [
-        sys.executable, "-m", "basic_pitch",
-        str(output_path),
-        str(vocals_path)
+    if isinstance(model_or_model_path, Model):
+        model = model_or_model_path
+    else:
+        model = Model(model_or_model_path)
+
+    overlap_len = BP_OVERLAPPING_FRAMES * FFT_HOP
+    hop_size = AUDIO_N_SAMPLES - overlap_len
+
+    original_length = audio.shape[0]
+    audio = np.concatenate([np.zeros(overlap_len // 2, dtype=np.float32), audio])
+
+    output = {"note": [], "onset": [], "contour": []}
+    for start in range(0, audio.shape[0], hop_size):
+        window = audio[start:start + AUDIO_N_SAMPLES]
+        if window.shape[0] < AUDIO_N_SAMPLES:
+            window = np.pad(window, (0, AUDIO_N_SAMPLES - window.shape[0]))
+
+        for key, value in model.predict(window[np.newaxis, :, np.newaxis]).items():
+            output[key].append(value)
+
+    return {
+        key: unwrap_output(np.concatenate(values), original_length, BP_OVERLAPPING_FRAMES)
+        for key, values in output.items()
+    }
+
+
+def _to_basic_pitch_input(vocals, sample_rate):
+    """
+    将人声下混为单声道并重采样到 Basic Pitch 的 22050 Hz
+
+    在人声所在的设备上用 torchaudio 只重采样一次，
+    避免 Basic Pitch 再在 CPU 上用 librosa 重采样。
+    """
+    import torch
+    import torchaudio
+    from basic_pitch.constants import AUDIO_SAMPLE_RATE
+
+    with torch.inference_mode():
+        audio = torch.as_tensor(vocals, dtype=torch.float32)
+        if audio.dim() > 1:
+            audio = audio.mean(0)
+        if sample_rate != AUDIO_SAMPLE_RATE:
+            audio = torchaudio.functional.resample(audio, sample_rate, AUDIO_SAMPLE_RATE)
+        return audio.cpu().numpy()
+
+
+def _build_note_kernels():
+    """
+    编译 numba 版本的 onset 峰值检测和音符提取函数
+
+    编译结果不写入磁盘缓存 (脚本目录随应用打包)，常驻模式下每个进程只编译一次。
+
+    Returns:
+        (onset_peaks, extract_notes)
+    """
+    import numba
+    import numpy as np
+
+    @numba.njit(fastmath=True, parallel=True)
+    def onset_peaks(onsets, onset_thresh):
+        """沿时间轴取不低于阈值的 onset 局部极大值 (与 scipy.signal.argrelmax 一致)"""
+        n_frames, n_freqs = onsets.shape
+        peaks = np.zeros(onsets.shape, dtype=np.bool_)
+        for t in numba.prange(1, n_frames - 1):
+            for f in range(n_freqs):
+                value = onsets[t, f]
+                if value >= onset_thresh and value > onsets[t - 1, f] and value > onsets[t + 1, f]:
+                    peaks[t, f] = True
+        return peaks
+
+    @numba.njit(fastmath=True)
+    def clear_energy(remaining, t, freq, max_freq_idx):
+        """清除某一帧上该音高及相邻半音的剩余能量"""
+        remaining[t, freq] = 0
+        if freq < max_freq_idx:
+            remaining[t, freq + 1] = 0
+        if freq > 0:
+            remaining[t, freq - 1] = 0
+
+    @numba.njit(fastmath=True)
+    def extract_notes(frames, onset_times, onset_freqs, frame_thresh, min_note_len,
+                      energy_tol, melodia_trick, max_freq_idx):
+        """
+        从 onset 峰值和帧激活中提取音符
+
+        与 basic_pitch.note_creation.output_to_notes_polyphonic 的贪心逻辑一致，
+        返回 (起始帧, 结束帧, 音高索引, 力度) 列表。
+        """
+        n_frames, n_freqs = frames.shape
+        remaining = frames.copy()
+        notes = []
+
+        for j in range(onset_times.shape[0]):
+            note_start = onset_times[j]
+            freq = onset_freqs[j]
+            if note_start >= n_frames - 1:
+                continue
+
+            i = note_start + 1
+            k = 0
+            while i < n_frames - 1 and k < energy_tol:
+                if remaining[i, freq] < frame_thresh:
+                    k += 1
+                else:
+                    k = 0
+                i += 1
+            i -= k
+
+            if i - note_start <= min_note_len:
+                continue
+
+            for t in range(note_start, i):
+                clear_energy(remaining, t, freq, max_freq_idx)
+            notes.append((note_start, i, freq, float(frames[note_start:i, freq].mean())))
+
+        if melodia_trick:
+            while True:
+                flat_idx = remaining.argmax()
+                i_mid = flat_idx // n_freqs
+                freq = flat_idx % n_freqs
+                if remaining[i_mid, freq] <= frame_thresh:
+                    break
+                remaining[i_mid, freq] = 0
+
+                # 向后扩展
+                i = i_mid + 1
+                k = 0
+                while i < n_frames - 1 and k < energy_tol:
+                    if remaining[i, freq] < frame_thresh:
+                        k += 1
+                    else:
+                        k = 0
+                    clear_energy(remaining, i, freq, max_freq_idx)
+                    i += 1
+                i_end = i - 1 - k
+
+                # 向前扩展
+                i = i_mid - 1
+                k = 0
+                while i > 0 and k < energy_tol:
+                    if remaining[i, freq] < frame_thresh:
+                        k += 1
+                    else:
+                        k = 0
+                    clear_energy(remaining, i, freq, max_freq_idx)
+                    i -= 1
+                i_start = i + 1 + k
+
+                if i_end - i_start <= min_note_len:
+                    continue
+                notes.append((i_start, i_end, freq, float(frames[i_start:i_end, freq].mean())))
+
+        return notes
+
+    return onset_peaks, extract_notes
+
+
+# numba 编译后的音符提取函数，首次使用时编译；numba 不可用时为 False
+_NOTE_KERNELS = None
+
+
+def _get_note_kernels():
+    """获取 (必要时编译) numba 版本的 onset 峰值检测和音符提取函数"""
+    global _NOTE_KERNELS
+    if _NOTE_KERNELS is None:
+        try:
+            _NOTE_KERNELS = _build_note_kernels()
+        except ImportError:
+            _NOTE_KERNELS = False
+    return _NOTE_KERNELS or None
+
+
+def _model_output_to_notes(model_output, min_note_len):
+    """
+    将 Basic Pitch 模型输出转换为 MIDI
+
+    音符提取的逐帧循环由 numba 编译为机器码；
+    numba 不可用时使用 basic_pitch 自带的纯 Python 实现。
+    """
+    import numpy as np
+    from basic_pitch import note_creation as infer
+
+    kernels = _get_note_kernels()
+    if kernels is None:
+        midi_data, _ = infer.model_output_to_notes(
+            model_output,
+            onset_thresh=BP_ONSET_THRESHOLD,
+            frame_thresh=BP_FRAME_THRESHOLD,
+            min_note_len=min_note_len,
+        )
+        return midi_data
+
+    onset_peaks, extract_notes = kernels
+    frames = np.ascontiguousarray(model_output["note"], dtype=np.float32)
+    onsets = infer.get_infered_onsets(model_output["onset"], model_output["note"])
+    onsets = np.ascontiguousarray(onsets, dtype=np.float32)
+
+    # 与 basic_pitch 一致，按时间和音高倒序处理 onset
+    onset_times, onset_freqs = np.nonzero(onset_peaks(onsets, BP_ONSET_THRESHOLD))
+    notes = extract_notes(
+        frames,
+        onset_times[::-1].copy(),
+        onset_freqs[::-1].copy(),
+        BP_FRAME_THRESHOLD,
+        min_note_len,
+        BP_ENERGY_TOLERANCE,
+        True,
+        infer.MAX_FREQ_IDX,
+    )
+
+    estimated_notes = [
+        (int(start), int(end), int(freq) + infer.MIDI_OFFSET, amplitude)
+        for start, end, freq, amplitude in notes
     ]
+    contours = model_output["contour"]
+    notes_with_pitch_bend = infer.get_pitch_bends(contours, estimated_notes)
+    times_s = infer.model_frames_to_time(contours.shape[0])
+    note_events = [
+        (times_s[note[0]], times_s[note[1]], note[2], note[3], note[4])
+        for note in notes_with_pitch_bend
+    ]
+    return infer.note_events_to_midi(note_events, multiple_pitch_bends=False)
+
 
+def convert_to_midi(vocals, sample_rate, midi_path, device="cpu"):
+    """
+    使用 Basic Pitch 将人声转换为 MIDI
+
+    Args:
+        vocals: 人声音频 [channels, samples] 或 [samples]
+        sample_rate: 人声采样率
+        midi_path: 输出 MIDI 文件路径
+        device: 使用的设备 (cuda/mps/cpu)
+
+    Returns:
+        midi_path: MIDI 文件路径
+    """
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=300  # 5 分钟超时
-        )
+        import numpy as np
+        from basic_pitch.constants import AUDIO_SAMPLE_RATE, FFT_HOP
 
-        if result.returncode != 0:
-            return None, f"Basic Pitch 执行失败: {result.stderr}"
+        # Basic Pitch 以 22050 Hz 单声道输入
+        audio = _to_basic_pitch_input(vocals, sample_rate)
 
-        # 查找输出的 MIDI 文件
-        # Basic Pitch 输出格式: output_dir/vocals_basic_pitch.mid
-        midi_name = vocals_path.stem + "_basic_pitch.mid"
-        midi_path = output_path / midi_name
+        model_output = _run_basic_pitch(audio, _get_bp_model(device))
 
-        if midi_path.exists():
-            return str(midi_path), None
-        else:
-            # 尝试查找任何 .mid 文件
-            for f in output_path.glob("*.mid"):
-                return str(f), None
-            return None, f"未找到 MIDI 文件，请检查 {output_path} 目录"
+        min_note_len = int(np.round(
+            BP_MINIMUM_NOTE_LENGTH_MS / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)
+        ))
+        midi_data = _model_output_to_notes(model_output, min_note_len)
+        midi_data.write(str(midi_path))
+
+        return str(midi_path), None
 
-    except subprocess.TimeoutExpired:
-        return None, "Basic Pitch 处理超时 (超过 5 分钟)"
     except Exception as e:
         return None, f"Basic Pitch 执行异常: {str(e)}"
 
@@ -264,21 +999,35 @@ def process_audio(input_mp3, output_dir=None):
         "tool": "Demucs"
     })
 
-    vocals_path, error = separate_vocals(
-        input_mp3,
-        output_path,
-        hardware["device"]
-    )
-
-    if error:
+    try:
+        wav = _decode_audio(input_path, DEMUCS_SAMPLERATE, DEMUCS_CHANNELS)
+    except Exception as e:
         result["status"] = "error"
         result["steps"][-1]["status"] = "failed"
-        result["steps"][-1]["error"] = error
+        result["steps"][-1]["error"] = f"音频解码失败: {str(e)}"
         return result
 
-    result["steps"][-1]["status"] = "completed"
-    result["steps"][-1]["output"] = vocals_path
-    result["vocals_file"] = vocals_path
+    if _is_vocal_stem(input_path, wav):
+        # 输入已是人声，直接交给 Basic Pitch
+        vocals = (wav, DEMUCS_SAMPLERATE)
+        result["steps"][-1]["status"] = "skipped"
+        result["steps"][-1]["skipped"] = "demucs"
+        result["steps"][-1]["reason"] = "already_vocal"
+    else:
+        vocals, error = separate_vocals(
+            input_mp3,
+            output_path,
+            hardware["device"],
+            wav=wav
+        )
+
+        if error:
+            result["status"] = "error"
+            result["steps"][-1]["status"] = "failed"
+            result["steps"][-1]["error"] = error
+            return result
+
+        result["steps"][-1]["status"] = "completed"
 
     # Step 2: 转换为 MIDI
     result["steps"].append({
@@ -288,7 +1037,14 @@ def process_audio(input_mp3, output_dir=None):
         "tool": "Basic Pitch"
     })
 
-    midi_path, error = convert_to_midi(vocals_path, output_path)
+    # 人声直接在内存中交给 Basic Pitch，不再经过 WAV 文件
+    audio, sample_rate = vocals
+    midi_path, error = convert_to_midi(
+        audio,
+        sample_rate,
+        output_path / (input_path.stem + ".mid"),
+        hardware["device"]
+    )
 
     if error:
         result["status"] = "error"
@@ -300,17 +1056,6 @@ def process_audio(input_mp3, output_dir=None):
     result["steps"][-1]["output"] = midi_path
     result["midi_file"] = midi_path
 
-    # 重命名 MIDI 文件为更友好的名称
-    final_midi_name = input_path.stem + ".mid"
-    final_midi_path = output_path / final_midi_name
-
-    if str(midi_path) != str(final_midi_path):
-        try:
-            shutil.move(midi_path, final_midi_path)
-            result["midi_file"] = str(final_midi_path)
-        except Exception:
-            pass  # 保持原文件名
-
     result["status"] = "success"
     result["message"] = "MP3 转 MIDI 完成"
     result["completed_at"] = datetime.now().isoformat()
@@ -318,6 +1063,160 @@ def process_audio(input_mp3, output_dir=None):
     return result
 
 
+def _collect_audio_files(paths):
+    """展开输入路径，目录按文件名顺序收集其中的 MP3 文件"""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.mp3")))
+        else:
+            files.append(path)
+    return [str(f) for f in files]
+
+
+def _pin_cpu_affinity(num_cpus):
+    """Linux 上将当前进程绑定到可用 CPU 中的前 num_cpus 个，提高缓存局部性"""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    available = sorted(os.sched_getaffinity(0))
+    try:
+        os.sched_setaffinity(0, available[:max(1, num_cpus)])
+    except OSError:
+        pass
+
+
+# 批量处理的进程数上限: 每个 worker 各自加载 htdemucs 和 Basic Pitch 模型
+BATCH_MAX_WORKERS = 4
+# 单个 worker 的内存估算 (模型权重 + htdemucs 分段推理激活)
+BATCH_WORKER_MEMORY_BYTES = 3 * 1024 ** 3
+
+
+def _batch_worker_limit():
+    """按物理内存估算可同时运行的 worker 数，不超过 BATCH_MAX_WORKERS"""
+    try:
+        total_memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return BATCH_MAX_WORKERS  # Windows 等不支持 sysconf 的平台
+    return max(1, min(BATCH_MAX_WORKERS, total_memory // BATCH_WORKER_MEMORY_BYTES))
+
+
+def _init_batch_worker(num_threads):
+    """批量处理子进程初始化: 按进程数均分 CPU 线程，避免 BLAS 超额订阅"""
+    # TensorFlow 在子进程中首次导入，按 worker 份额设置其线程数
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(num_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+
+
+def process_audio_batch(files, output_dir=None):
+    """
+    批量处理多个音频文件
+
+    CPU 模式下使用进程池并行处理，进程数受内存估算和 BATCH_MAX_WORKERS 限制；
+    CUDA/MPS 下 GPU 是瓶颈，改为在当前进程中串行处理，让已加载的模型常驻复用。
+
+    Args:
+        files: 输入 MP3 文件路径列表
+        output_dir: 输出目录 (默认为各输入文件所在目录)
+
+    Returns:
+        批量处理结果字典
+    """
+    if not files:
+        return {
+            "status": "error",
+            "error": "未找到待处理的音频文件"
+        }
+
+    hardware = detect_hardware()
+
+    if hardware["device"] == "cpu":
+        max_workers = min(len(files), os.cpu_count() or 1, _batch_worker_limit())
+    else:
+        max_workers = 1
+
+    if max_workers == 1:
+        results = [process_audio(f, output_dir) for f in files]
+    else:
+        num_threads = max(1, (os.cpu_count() or 1) // max_workers)
+        results = []
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_batch_worker,
+            initargs=(num_threads,)
+        ) as executor:
+            futures = [executor.submit(process_audio, f, output_dir) for f in files]
+            for f, future in zip(files, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({
+                        "status": "error",
+                        "input_file": f,
+                        "error": f"处理进程异常: {str(e)}"
+                    })
+
+    succeeded = sum(1 for r in results if r["status"] == "success")
+
+    return {
+        "status": "success" if succeeded == len(files) else "error",
+        "hardware": hardware,
+        "workers": max_workers,
+        "total": len(files),
+        "succeeded": succeeded,
+        "results": results,
+        "completed_at": datetime.now().isoformat()
+    }
+
+
+def serve():
+    """
+    常驻模式: 从 stdin 逐行读取 JSON 任务，每个任务输出一个 JSON 结果
+
+    任务格式: {"input": "<input_mp3>", "output_dir": "<output_dir>"}
+    启动时预先加载 Demucs 和 Basic Pitch 模型，整个会话内复用，
+    省去每次转换的解释器启动、依赖导入和模型加载开销。
+
+    协议输出使用复制出来的原始 stdout，fd 1 和 sys.stdout 改指向 stderr，
+    避免依赖库 (如 Basic Pitch 的 CoreML 推理) 的 print 混入 JSON 流。
+    """
+    global _PROTOCOL_OUT
+    sys.stdout.flush()
+    _PROTOCOL_OUT = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    hardware = detect_hardware()
+    try:
+        _get_demucs_model(hardware["device"])
+        _get_bp_model(hardware["device"])
+    except Exception:
+        pass  # 依赖缺失或加载失败时，由 process_audio 返回具体错误
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            job = json.loads(line)
+            result = process_audio(job["input"], job.get("output_dir"))
+        except Exception as e:
+            result = {
+                "status": "error",
+                "error": f"任务处理异常: {str(e)}"
+            }
+
+        try:
+            output_json(result, compact=True)
+        except BrokenPipeError:
+            return  # 调用方已退出
+
+
 def main():
     """主函数"""
     if len(sys.argv) < 2:
@@ -328,6 +1227,8 @@ def main():
             "examples": [
                 "python audio_to_midi.py song.mp3",
                 "python audio_to_midi.py song.mp3 ./output",
+                "python audio_to_midi.py --batch ./songs -o ./output",
+                "python audio_to_midi.py --serve",
                 "python audio_to_midi.py --check"
             ]
         })
@@ -353,6 +1254,32 @@ def main():
         })
         sys.exit(0 if all_installed else 1)
 
+    # 单进程模式下绑定 CPU；批量模式由各 worker 自行分配线程
+    if sys.argv[1] != "--batch":
+        try:
+            _pin_cpu_affinity(int(os.environ["OMP_NUM_THREADS"]))
+        except ValueError:
+            pass
+
+    # 常驻模式
+    if sys.argv[1] == "--serve":
+        serve()
+        sys.exit(0)
+
+    # 批量模式
+    if sys.argv[1] == "--batch":
+        args = sys.argv[2:]
+        output_dir = None
+        if "-o" in args:
+            index = args.index("-o")
+            output_dir = args[index + 1] if index + 1 < len(args) else None
+            del args[index:index + 2]
+
+        result = process_audio_batch(_collect_audio_files(args), output_dir)
+        output_json(result)
+
+        sys.exit(0 if result["status"] == "success" else 1)
+
     # 处理模式
     input_mp3 = sys.argv[1]
     output_dir = sys.argv[2] if len(sys.argv) > 2 else None
@@ -1,6 +1,12 @@
+use once_cell::sync::Lazy;
+use parking_lot::Mutex;
 use serde::{Deserialize, Serialize};
+use serde_json::Value;
+use std::io::{BufReader, Write};
 use std::path::PathBuf;
-use std::process::Command;
+use std::process::{Child, ChildStdin, Command, Stdio};
+use std::sync::mpsc::{self, Receiver, RecvTimeoutError};
+use std::time::{Duration, Instant};
 use tauri::State;
 
 /// MIDI 分析结果
@@ -125,22 +131,145 @@ pub async fn analyze_midi(midi_path: String) -> Result<MidiAnalysisResult, Strin
         .map_err(|e| format!("Failed to parse analysis result: {}", e))
 }
 
+/// 常驻的 MP3 转 MIDI Python 进程
+///
+/// 进程以 `--serve` 模式只启动一次，Demucs 和 Basic Pitch 模型常驻其中，
+/// 每次转换通过 stdin 发送一行 JSON 任务，再从 stdout 读取 JSON 结果。
+/// stdout 由后台线程解析后经 channel 转发，以便等待结果时可以超时
+struct AudioToMidiDaemon {
+    child: Child,
+    stdin: ChildStdin,
+    results: Receiver<Result<Value, String>>,
+}
+
+/// 单个转换任务的超时时间 (与原 Demucs 30 分钟 + Basic Pitch 5 分钟的子进程超时一致)
+const AUDIO_TO_MIDI_TIMEOUT: Duration = Duration::from_secs(35 * 60);
+
+impl AudioToMidiDaemon {
+    /// 启动常驻进程
+    fn spawn() -> Result<Self, String> {
+        let script_path = get_resource_path("scripts/audio_to_midi.py")?;
+
+        let mut child = Command::new("python3")
+            .arg(&script_path)
+            .arg("--serve")
+            .stdin(Stdio::piped())
+            .stdout(Stdio::piped())
+            .stderr(Stdio::inherit())
+            .spawn()
+            .map_err(|e| format!("Failed to execute Python script: {}", e))?;
+
+        let stdin = child
+            .stdin
+            .take()
+            .ok_or_else(|| "Failed to open Python stdin".to_string())?;
+        let stdout = child
+            .stdout
+            .take()
+            .ok_or_else(|| "Failed to open Python stdout".to_string())?;
+
+        let (sender, results) = mpsc::channel();
+        std::thread::spawn(move || {
+            let values =
+                serde_json::Deserializer::from_reader(BufReader::new(stdout)).into_iter::<Value>();
+            for value in values {
+                let value = value.map_err(|e| format!("Failed to parse conversion result: {}", e));
+                if sender.send(value).is_err() {
+                    break;
+                }
+            }
+        });
+
+        Ok(Self {
+            child,
+            stdin,
+            results,
+        })
+    }
+
+    /// 发送一个转换任务并等待结果 (跳过中间的 progress 事件)
+    ///
+    /// 超过 `timeout` 仍未得到结果时返回错误，由调用方丢弃 (终止) 进程
+    fn convert(
+        &mut self,
+        mp3_path: &str,
+        output_path: &str,
+        timeout: Duration,
+    ) -> Result<Value, String> {
+        let job = serde_json::json!({
+            "input": mp3_path,
+            "output_dir": output_path,
+        });
+        writeln!(self.stdin, "{}", job)
+            .and_then(|_| self.stdin.flush())
+            .map_err(|e| format!("Failed to send job to Python process: {}", e))?;
+
+        let deadline = Instant::now() + timeout;
+        loop {
+            let remaining = deadline.saturating_duration_since(Instant::now());
+            let value = match self.results.recv_timeout(remaining) {
+                Ok(value) => value?,
+                Err(RecvTimeoutError::Timeout) => {
+                    return Err(format!(
+                        "MP3 to MIDI conversion timed out after {} seconds",
+                        timeout.as_secs()
+                    ))
+                }
+                Err(RecvTimeoutError::Disconnected) => {
+                    return Err("Python process exited unexpectedly".to_string())
+                }
+            };
+            if value.get("status").and_then(Value::as_str) != Some("progress") {
+                return Ok(value);
+            }
+        }
+    }
+}
+
+impl Drop for AudioToMidiDaemon {
+    fn drop(&mut self) {
+        let _ = self.child.kill();
+        let _ = self.child.wait();
+    }
+}
+
+static AUDIO_TO_MIDI_DAEMON: Lazy<Mutex<Option<AudioToMidiDaemon>>> =
+    Lazy::new(|| Mutex::new(None));
+
 /// 将 MP3 转换为 MIDI
 #[tauri::command]
 pub async fn convert_mp3_to_midi(mp3_path: String, output_path: String) -> Result<String, String> {
-    // 获取 Python 脚本路径
-    let script_path = get_resource_path("scripts/audio_to_midi.py")?;
-
-    // 调用 Python 脚本
-    let output = Command::new("python3")
-        .arg(&script_path)
-        .arg(&mp3_path)
-        .arg(&output_path)
-        .output()
-        .map_err(|e| format!("Failed to execute Python script: {}", e))?;
-
-    if !output.status.success() {
-        let error = String::from_utf8_lossy(&output.stderr);
+    // 与 Python 进程的阻塞通信放到阻塞线程池，避免占住异步运行时的工作线程
+    let job_output_path = output_path.clone();
+    let result = tauri::async_runtime::spawn_blocking(move || {
+        let mut daemon = AUDIO_TO_MIDI_DAEMON.lock();
+
+        // 首次调用时启动常驻进程，后续转换复用
+        let mut running = match daemon.take() {
+            Some(running) => running,
+            None => AudioToMidiDaemon::spawn()?,
+        };
+
+        // 通信失败或超时时进程随 running 一起被丢弃 (终止)，下次调用重新启动
+        let result = running.convert(&mp3_path, &job_output_path, AUDIO_TO_MIDI_TIMEOUT)?;
+        *daemon = Some(running);
+        Ok::<Value, String>(result)
+    })
+    .await
+    .map_err(|e| format!("MP3 to MIDI conversion task failed: {}", e))??;
+
+    if result.get("status").and_then(Value::as_str) != Some("success") {
+        let error = result
+            .get("error")
+            .or_else(|| {
+                result
+                    .get("steps")
+                    .and_then(Value::as_array)
+                    .and_then(|steps| steps.last())
+                    .and_then(|step| step.get("error"))
+            })
+            .and_then(Value::as_str)
+            .unwrap_or("unknown error");
         return Err(format!("MP3 to MIDI conversion failed: {}", error));
     }
 